@@ -1,17 +1,37 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi.responses import ORJSONResponse
+from pymongo import AsyncMongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import asyncio
 import os
 import logging
 import re
 import uuid
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from pydantic import BaseModel, Field, ConfigDict, field_validator
-from typing import Optional, List, Dict
+from typing import Annotated, Optional, List, Dict
 
 # ------------------ APP INIT ------------------
 
-app = FastAPI(title="Ethara.AI HRMS API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Run one-off data migrations and build all indexes once at boot;
+    # duplicates must be gone before the unique indexes are built
+    await migrate_string_timestamps()
+    await remove_duplicate_attendance()
+    await ensure_indexes()
+    await backfill_search_keys()
+    yield
+    await client.close()
+
+
+app = FastAPI(
+    title="Ethara.AI HRMS API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # ------------------ CORS (ROBUST SETUP) ------------------
 
@@ -37,6 +57,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Offset"],
 )
 
 # ------------------ DATABASE ------------------
@@ -49,15 +70,154 @@ if not MONGO_URL:
     print("WARNING: MONGO_URL not found, using default localhost.")
     MONGO_URL = "mongodb://localhost:27017"
 
-client = AsyncIOMotorClient(MONGO_URL)
+# Size the pool for workers * expected in-flight requests
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "200"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "20"))
+
+client = AsyncMongoClient(
+    MONGO_URL,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=3000,
+    compressors="zstd,zlib",
+    retryWrites=True,
+    # Return stored datetimes as UTC-aware so responses carry the offset
+    tz_aware=True,
+    tzinfo=timezone.utc
+)
 db = client[DB_NAME]
 
+ATTENDANCE_COVERING_INDEX = "attendance_by_employee_covered"
+
+
+async def ensure_unique_index(collection, field):
+    # Employees are not deleted automatically: if old racing inserts left
+    # duplicates, name them and keep the app up instead of failing startup
+    try:
+        await collection.create_index(field, unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        duplicates = await aggregate_list(collection, [
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ], None)
+        logger.error(
+            "Cannot build unique index on %s.%s, duplicate values: %s. "
+            "Duplicates are not rejected until these are resolved.",
+            collection.name, field, ", ".join(str(d["_id"]) for d in duplicates)
+        )
+
+
+async def ensure_indexes():
+    await ensure_unique_index(db.employees, "employee_id")
+    await ensure_unique_index(db.employees, "email")
+    await db.employees.create_index(
+        [("full_name", "text"), ("email", "text"), ("employee_id", "text")],
+        weights={"full_name": 10, "employee_id": 5, "email": 3},
+        name="emp_text"
+    )
+    await db.employees.create_index("name_terms")
+    await db.employees.create_index("email_lc")
+    await db.employees.create_index("employee_id_lc")
+    await db.attendance.create_index([("employee_id", 1), ("date", 1)], unique=True)
+    await db.attendance.create_index([("marked_at", -1)])
+    await db.attendance.create_index([("date", 1), ("status", 1)])
+    await db.attendance.create_index(
+        [("employee_id", 1), ("date", 1), ("status", 1), ("marked_at", 1), ("id", 1)],
+        name=ATTENDANCE_COVERING_INDEX
+    )
+
+
+def search_keys(employee):
+    # Lowercased copies for case-insensitive prefix search: $regex ignores
+    # collation, so an anchored regex on these is the only index-friendly way
+    return {
+        "name_terms": employee["full_name"].lower().split(),
+        "email_lc": employee["email"].lower(),
+        "employee_id_lc": employee["employee_id"].lower()
+    }
+
+
+async def backfill_search_keys():
+    # One-off for employees created before the search keys existed
+    cursor = db.employees.find(
+        {"email_lc": {"$exists": False}},
+        {"full_name": 1, "email": 1, "employee_id": 1}
+    )
+    ops = [
+        UpdateOne({"_id": employee["_id"]}, {"$set": search_keys(employee)})
+        async for employee in cursor
+    ]
+    if ops:
+        await db.employees.bulk_write(ops, ordered=False)
+
+
+async def migrate_string_timestamps():
+    # One-off: timestamps used to be stored as ISO strings; convert them to
+    # BSON datetimes so each field has a single type for sorting
+    for collection, field in ((db.employees, "created_at"), (db.attendance, "marked_at")):
+        ops = []
+        async for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+            try:
+                value = datetime.fromisoformat(doc[field])
+            except ValueError:
+                logger.warning("Skipping unparseable %s on %s", field, doc["_id"])
+                continue
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: value}}))
+        if ops:
+            await collection.bulk_write(ops, ordered=False)
+
+
+async def remove_duplicate_attendance():
+    # One-off: the old find-then-insert path could race and leave several
+    # rows for one (employee_id, date); keep the latest marked_at of each
+    cursor = await db.attendance.aggregate([
+        {"$sort": {"marked_at": -1, "_id": -1}},
+        {"$group": {
+            "_id": {"employee_id": "$employee_id", "date": "$date"},
+            "ids": {"$push": "$_id"}
+        }},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ], allowDiskUse=True)
+
+    stale_ids = []
+    async for group in cursor:
+        logger.warning(
+            "Removing %d duplicate attendance rows for %s on %s",
+            len(group["ids"]) - 1, group["_id"]["employee_id"], group["_id"]["date"]
+        )
+        stale_ids.extend(group["ids"][1:])
+
+    if stale_ids:
+        await db.attendance.delete_many({"_id": {"$in": stale_ids}})
+
+
+async def aggregate_list(collection, pipeline, length):
+    cursor = await collection.aggregate(pipeline)
+    return await cursor.to_list(length=length)
+
+
+async def fetch_page(cursor, offset, limit, response):
+    # Read one extra row to tell the client whether another page exists
+    docs = await cursor.skip(offset).limit(limit + 1).batch_size(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+        return docs[:limit]
+    return docs
+
 # ------------------ ROUTER ------------------
 
 api_router = APIRouter(prefix="/api")
 
 # ------------------ MODELS ------------------
 
+EMAIL_RE = re.compile(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
+EMPLOYEE_ID_RE = re.compile(r"^(?=.*\d)[A-Z0-9-]+$")
+COMPLETE_WORD_RE = re.compile(r"\S\s")
+
 class EmployeeCreate(BaseModel):
     employee_id: str
     full_name: str
@@ -74,20 +234,19 @@ class EmployeeCreate(BaseModel):
     @field_validator("email")
     @classmethod
     def validate_email(cls, v):
-        pattern = r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$"
-        if not re.match(pattern, v):
+        if not EMAIL_RE.match(v):
             raise ValueError("Invalid email format")
         return v.strip()
 
 
 class Employee(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     employee_id: str
     full_name: str
     email: str
     department: str
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime
 
 
 class AttendanceCreate(BaseModel):
@@ -112,50 +271,97 @@ class AttendanceCreate(BaseModel):
 
 class AttendanceRecord(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: uuid.uuid4().hex)
     employee_id: str
     date: str
     status: str
-    marked_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    marked_at: datetime
+
+# ------------------ PROJECTIONS ------------------
+
+# Only the fields the frontend renders
+EMPLOYEE_PROJECTION = {
+    "_id": 0, "id": 1, "employee_id": 1, "full_name": 1,
+    "email": 1, "department": 1, "created_at": 1
+}
+ATTENDANCE_PROJECTION = {
+    "_id": 0, "id": 1, "employee_id": 1, "date": 1,
+    "status": 1, "marked_at": 1
+}
+
+# Deterministic page order for skip/limit pagination; attendance is newest first
+EMPLOYEE_SORT = [("_id", 1)]
+ATTENDANCE_SORT = [("employee_id", -1), ("date", -1)]
 
 # ------------------ EMPLOYEE APIs ------------------
 
 @api_router.post("/employees")
 async def create_employee(emp: EmployeeCreate):
-    # Check for duplicates
-    if await db.employees.find_one({"employee_id": emp.employee_id}):
+    now = datetime.now(timezone.utc)
+    doc = Employee(**emp.model_dump(), created_at=now).model_dump()
+
+    # Unique indexes enforce duplicates atomically in a single round trip
+    try:
+        await db.employees.insert_one({**doc, **search_keys(doc)})
+    except DuplicateKeyError as e:
+        key_pattern = (e.details or {}).get("keyPattern", {})
+        if "email" in key_pattern:
+            raise HTTPException(status_code=409, detail="Email already exists")
         raise HTTPException(status_code=409, detail="Employee ID already exists")
 
-    if await db.employees.find_one({"email": emp.email}):
-        raise HTTPException(status_code=409, detail="Email already exists")
-
-    employee = Employee(**emp.model_dump())
-    await db.employees.insert_one(employee.model_dump())
-    return employee
+    return doc
 
 
 @api_router.get("/employees")
 async def get_employees(
+    response: Response,
     search: Optional[str] = None, 
-    department: Optional[str] = None
+    department: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0)
 ):
-    query = {}
-
-    # Filter by Department
-    if department and department.lower() != "all":
-        query["department"] = department
-
-    # Filter by Search (Case Insensitive Regex)
-    if search:
-        search_regex = {"$regex": search, "$options": "i"}
-        query["$or"] = [
-            {"full_name": search_regex},
-            {"email": search_regex},
-            {"employee_id": search_regex}
-        ]
+    filter_department = bool(department) and department.lower() != "all"
 
-    employees = await db.employees.find(query, {"_id": 0}).to_list(1000)
-    return employees
+    # Fast path: plain listing, nothing to build
+    if not search and not filter_department:
+        cursor = db.employees.find({}, EMPLOYEE_PROJECTION).sort(EMPLOYEE_SORT)
+    else:
+        query = {}
+
+        # Filter by Department
+        if filter_department:
+            query["department"] = department
+
+        sort = []
+
+        # Filter by Search
+        if search:
+            prefix_regex = {"$regex": "^" + re.escape(search.lower())}
+
+            if "@" in search:
+                # Looks like an email: single prefix scan on the email index
+                query["email_lc"] = prefix_regex
+            elif EMPLOYEE_ID_RE.match(search):
+                # Looks like an employee ID (upper-case with a digit): single
+                # prefix scan on its index; all-caps words still search names
+                query["employee_id_lc"] = prefix_regex
+            elif COMPLETE_WORD_RE.search(search):
+                # At least one whole word typed: indexed full-text search,
+                # best matches first ($text only matches complete words)
+                query["$text"] = {"$search": search}
+                sort = [("score", {"$meta": "textScore"})]
+            else:
+                # Partial word while typing: an anchored regex on the lowercased
+                # keys is a bounded IXSCAN; name_terms matches any name word
+                query["$or"] = [
+                    {"name_terms": prefix_regex},
+                    {"email_lc": prefix_regex},
+                    {"employee_id_lc": prefix_regex}
+                ]
+
+        cursor = db.employees.find(query, EMPLOYEE_PROJECTION).sort(sort + EMPLOYEE_SORT)
+
+    return await fetch_page(cursor, offset, limit, response)
 
 
 @api_router.delete("/employees/{employee_id}")
@@ -172,85 +378,150 @@ async def delete_employee(employee_id: str):
 
 @api_router.post("/attendance")
 async def mark_attendance(att: AttendanceCreate):
+    now = datetime.now(timezone.utc)
+
     # 1. Verify employee exists
-    if not await db.employees.find_one({"employee_id": att.employee_id}):
+    if not await db.employees.find_one({"employee_id": att.employee_id}, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Employee not found")
 
-    # Check for existing record (Upsert Logic)
-    existing_record = await db.attendance.find_one({
-        "employee_id": att.employee_id,
-        "date": att.date
-    })
+    # 2. Upsert on the unique (employee_id, date) index in a single round trip
+    record = AttendanceRecord(**att.model_dump(), marked_at=now).model_dump()
+    previous = await db.attendance.find_one_and_update(
+        {"employee_id": att.employee_id, "date": att.date},
+        {
+            "$set": {"status": record["status"], "marked_at": record["marked_at"]},
+            "$setOnInsert": {
+                "id": record["id"],
+                "employee_id": record["employee_id"],
+                "date": record["date"]
+            }
+        },
+        projection={"_id": 0, "id": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
 
-    if existing_record:
-        # Update existing
-        await db.attendance.update_one(
-            {"_id": existing_record["_id"]},
+    if previous:
+        return {**record, "id": str(previous.get("id")), "message": "Attendance updated"}
+
+    return record
+
+
+# Keeps the $in lookup and bulk_write well under MongoDB's 16 MB command limit
+BULK_ATTENDANCE_LIMIT = 1000
+
+
+@api_router.post("/attendance/bulk")
+async def mark_attendance_bulk(
+    items: Annotated[List[AttendanceCreate], Field(min_length=1, max_length=BULK_ATTENDANCE_LIMIT)]
+):
+    now = datetime.now(timezone.utc)
+
+    # Last mark wins when the same employee/date appears more than once
+    marks = {(att.employee_id, att.date): att for att in items}
+
+    # 1. Verify all employees exist (one round trip)
+    employee_ids = {employee_id for employee_id, _ in marks}
+    found = await db.employees.distinct("employee_id", {"employee_id": {"$in": list(employee_ids)}})
+    missing = sorted(employee_ids - set(found))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Employees not found: {', '.join(missing)}")
+
+    # 2. Upsert every mark in a single unordered bulk write
+    ops = [
+        UpdateOne(
+            {"employee_id": att.employee_id, "date": att.date},
             {
-                "$set": {
-                    "status": att.status,
-                    "marked_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
+                "$set": {"status": att.status, "marked_at": now},
+                "$setOnInsert": {"id": uuid.uuid4().hex}
+            },
+            upsert=True
         )
-        # Return updated structure
-        return {**existing_record, "status": att.status, "message": "Attendance updated", "id": str(existing_record.get("id"))}
-    
-    else:
-        # Create new
-        record = AttendanceRecord(**att.model_dump())
-        await db.attendance.insert_one(record.model_dump())
-        return record
+        for att in marks.values()
+    ]
+    result = await db.attendance.bulk_write(ops, ordered=False)
+
+    return {
+        "message": "Attendance marked",
+        "created": result.upserted_count,
+        "updated": result.matched_count
+    }
 
 
 @api_router.get("/attendance")
-async def get_attendance(employee_id: Optional[str] = None):
+async def get_attendance(
+    response: Response,
+    employee_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0)
+):
     query = {"employee_id": employee_id} if employee_id else {}
-    return await db.attendance.find(query, {"_id": 0}).to_list(5000)
+    cursor = db.attendance.find(query, ATTENDANCE_PROJECTION).sort(ATTENDANCE_SORT)
+
+    # Every projected field lives in the covering index: no document fetches
+    if employee_id:
+        cursor = cursor.hint(ATTENDANCE_COVERING_INDEX)
+
+    return await fetch_page(cursor, offset, limit, response)
 
 # ------------------ DASHBOARD API (FIXED) ------------------
 
 @api_router.get("/dashboard")
 async def dashboard():
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    now = datetime.now(timezone.utc)
+    today = now.strftime("%Y-%m-%d")
+
+    # 1. Employee total + Department Breakdown (one round trip)
+    employee_pipeline = [
+        {"$facet": {
+            "total": [{"$count": "n"}],
+            "by_dept": [{"$group": {"_id": "$department", "count": {"$sum": 1}}}]
+        }}
+    ]
 
-    # 1. Basic Counts
-    total_employees = await db.employees.count_documents({})
-    
-    # Get today's attendance records
-    today_records = await db.attendance.find({"date": today}).to_list(length=1000)
-    
-    present = sum(1 for r in today_records if r.get("status") == "Present")
-    absent = sum(1 for r in today_records if r.get("status") == "Absent")
+    # 2. Today's attendance counted server-side
+    status_pipeline = [
+        {"$match": {"date": today}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]
 
-    # 2. Department Breakdown
-    # Using explicit length instead of None to ensure compatibility
-    pipeline = [
-        {"$group": {"_id": "$department", "count": {"$sum": 1}}}
+    # 3. Recent Activity (server-side join with employees)
+    recent_pipeline = [
+        {"$sort": {"marked_at": -1}},
+        {"$limit": 5},
+        {"$lookup": {
+            "from": "employees",
+            "localField": "employee_id",
+            "foreignField": "employee_id",
+            "as": "emp"
+        }},
+        {"$project": {
+            "_id": 0,
+            "id": {"$toString": "$_id"},
+            "action": {"$concat": ["Marked ", "$status"]},
+            "employee": {"$ifNull": [{"$first": "$emp.full_name"}, "Unknown"]},
+            "time": "$marked_at"
+        }}
     ]
-    dept_counts = await db.employees.aggregate(pipeline).to_list(length=100)
-    
+
+    # The three pipelines are independent, so run them concurrently
+    employee_stats, status_counts, recent_logs = await asyncio.gather(
+        aggregate_list(db.employees, employee_pipeline, 1),
+        aggregate_list(db.attendance, status_pipeline, 10),
+        aggregate_list(db.attendance, recent_pipeline, 5)
+    )
+
+    stats = employee_stats[0] if employee_stats else {}
+    total_employees = stats["total"][0]["n"] if stats.get("total") else 0
+
     department_breakdown = {
         (item["_id"] if item["_id"] else "Unassigned"): item["count"] 
-        for item in dept_counts
+        for item in stats.get("by_dept", [])
     }
 
-    # 3. Recent Activity
-    # Fixed sort syntax: .sort([("field", direction)])
-    recent_activity_cursor = db.attendance.find().sort([("marked_at", -1)]).limit(5)
-    
-    recent_logs = []
-    async for record in recent_activity_cursor:
-        # Get employee name
-        emp = await db.employees.find_one({"employee_id": record["employee_id"]})
-        name = emp["full_name"] if emp else "Unknown"
-        
-        recent_logs.append({
-            "id": str(record.get("_id")),
-            "action": f"Marked {record.get('status')}",
-            "employee": name,
-            "time": record.get("marked_at")
-        })
+    counts = {item["_id"]: item["count"] for item in status_counts}
+    present = counts.get("Present", 0)
+    absent = counts.get("Absent", 0)
 
     return {
         "total_employees": total_employees,
@@ -277,7 +548,3 @@ app.include_router(api_router)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("ethara")
-
-@app.on_event("shutdown")
-async def shutdown():
-    client.close()